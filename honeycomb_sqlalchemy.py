@@ -1,8 +1,11 @@
 # -*- coding: utf-8 -*-
 import datetime
 import logging
+import random
 import threading
+import time
 import warnings
+from contextvars import ContextVar
 
 import beeline
 from sqlalchemy import event
@@ -12,101 +15,237 @@ from sqlalchemy.engine import Engine
 log = logging.getLogger(__name__)
 
 
+# formatters for parameter types that don't serialise usefully as-is, keyed on the
+# exact type so that lookups skip isinstance's walk over the MRO
+_FORMATTERS = {
+    datetime.datetime: datetime.datetime.isoformat,
+    datetime.date: datetime.date.isoformat,
+    datetime.time: datetime.time.isoformat,
+}
+
+
+def _format_params(parameters):
+    formatters = _FORMATTERS
+
+    # the type of parameters passed in varies depending on DB.
+    # handle list, dict, and tuple
+    if type(parameters) is tuple or type(parameters) is list:
+        # most statements have no parameters at all
+        if not parameters:
+            return []
+        if formatters.keys().isdisjoint(map(type, parameters)):
+            return list(parameters)
+        return [
+            formatters[type(param)](param) if type(param) in formatters else param
+            for param in parameters
+        ]
+    if type(parameters) is dict:
+        return [
+            f"{k}={formatters[type(v)](v) if type(v) in formatters else v!s}"
+            for k, v in parameters.items()
+        ]
+    return []
+
+
+def _is_select(statement):
+    # last insert ids are meaningless for reads, and some drivers do extra work
+    # to look them up
+    # slice first so that huge statements aren't copied by lstrip
+    return statement[:32].lstrip()[:6].upper() == "SELECT"
+
+
+# fields shared by every query span; copied rather than rebuilt per query
+_BASE_CONTEXT = {"name": "sqlalchemy_query", "type": "db"}
+
+# minimum number of seconds between overlapping event warnings
+_OVERLAP_WARN_INTERVAL = 60
+
+# state of the query in progress, as a (span, start time, pending span context)
+# tuple so that each transition is a single set. A context variable rather than a
+# thread local, so that queries from asyncio tasks sharing a thread don't trample
+# each other's state
+_query_state = ContextVar("honeycomb_sqlalchemy_query_state", default=None)
+_NO_STATE = (None, None, None)
+
+
 class SqlalchemyListeners(object):
-    def __init__(self):
-        self.state = threading.local()
-        self.reset_state()
+    # the Engine events are global, so only one set of listeners is ever installed
+    # per process, no matter how many instances are created
+    _install_lock = threading.Lock()
+    _installed = None
+
+    def __init__(self, min_duration_ms=None, sample_rate=None):
+        # when either is set, spans are only sent for queries that take at least
+        # min_duration_ms, or for a sample_rate fraction of the remaining ones
+        self.min_duration_ms = min_duration_ms
+        self.sample_rate = sample_rate
+        self.deferred = min_duration_ms is not None or sample_rate is not None
 
-        self.installed = False
+        # overlapping events since the last query span, reported on the next one
+        # that is sent. Shared between threads and tasks, so guarded by a lock
+        self._overlap_lock = threading.Lock()
+        self._overlap_count = 0
+        self._overlap_last_warn = None
+
+    @property
+    def installed(self):
+        return SqlalchemyListeners._installed is self
 
     def install(self):
-        if self.installed:
-            log.info("sqlalchemy listeners already installed, ignoring")
-            return
+        with SqlalchemyListeners._install_lock:
+            if SqlalchemyListeners._installed is self:
+                log.info("sqlalchemy listeners already installed, ignoring")
+                return
+            if SqlalchemyListeners._installed is not None:
+                log.warning(
+                    "a different set of sqlalchemy listeners is already installed, "
+                    "ignoring. Uninstall it first to use these listeners instead"
+                )
+                return
 
-        self.installed = True
+            SqlalchemyListeners._installed = self
 
-        event.listen(Engine, "before_cursor_execute", self.before_cursor_execute)
-        event.listen(Engine, "after_cursor_execute", self.after_cursor_execute)
-        event.listen(Engine, "handle_error", self.handle_error)
+            event.listen(Engine, "before_cursor_execute", self.before_cursor_execute)
+            event.listen(Engine, "after_cursor_execute", self.after_cursor_execute)
+            event.listen(Engine, "handle_error", self.handle_error)
 
     def uninstall(self):
+        with SqlalchemyListeners._install_lock:
+            if SqlalchemyListeners._installed is not self:
+                return
 
-        event.remove(Engine, "before_cursor_execute", self.before_cursor_execute)
-        event.remove(Engine, "after_cursor_execute", self.after_cursor_execute)
-        event.remove(Engine, "handle_error", self.handle_error)
+            event.remove(Engine, "before_cursor_execute", self.before_cursor_execute)
+            event.remove(Engine, "after_cursor_execute", self.after_cursor_execute)
+            event.remove(Engine, "handle_error", self.handle_error)
 
-        self.installed = False
+            SqlalchemyListeners._installed = None
 
     def reset_state(self):
-        self.state.span = None
-        self.state.query_start_time = None
+        _query_state.set(None)
 
     def before_cursor_execute(
         self, conn, cursor, statement, parameters, context, executemany
     ):
-        span = getattr(self.state, "span", None)
-        query_start_time = getattr(self.state, "query_start_time", None)
-
-        if span or query_start_time:
-            warnings.warn(
-                "The before_cursor_execute event fired multiple times inside the same "
-                "thread, without a corresponding after_cursor_execute or handle_error "
-                "event."
-            )
+        if _query_state.get() is not None:
+            with self._overlap_lock:
+                self._overlap_count += 1
+
+            now = time.monotonic()
+            if (
+                self._overlap_last_warn is None
+                or now - self._overlap_last_warn > _OVERLAP_WARN_INTERVAL
+            ):
+                self._overlap_last_warn = now
+                warnings.warn(
+                    "The before_cursor_execute event fired multiple times inside the "
+                    "same thread or task, without a corresponding after_cursor_execute "
+                    "or handle_error event."
+                )
             return
 
-        params = []
-
-        # the type of parameters passed in varies depending on DB.
-        # handle list, dict, and tuple
-        if type(parameters) == tuple or type(parameters) == list:
-            for param in parameters:
-                if type(param) == datetime.datetime:
-                    param = param.isoformat()
-                params.append(param)
-        elif type(parameters) == dict:
-            for k, v in parameters.items():
-                param = "%s=" % k
-                if type(v) == datetime.datetime:
-                    v = v.isoformat()
-                param += str(v)
-                params.append(param)
-
-        self.state.span = beeline.start_span(
-            context={
-                "name": "sqlalchemy_query",
-                "type": "db",
-                "db.query": statement,
-                "db.query_args": params,
-            }
-        )
-        self.state.query_start_time = datetime.datetime.now()
+        params = _format_params(parameters)
+
+        context = _BASE_CONTEXT.copy()
+        context["db.query"] = statement
+        context["db.query_args"] = params
+
+        if self.deferred:
+            # the span is only started once we know the query is worth sending
+            span, pending = None, context
+        else:
+            overlap_count = self.take_overlap_count()
+            if overlap_count:
+                context["db.overlap_count"] = overlap_count
+            span, pending = beeline.start_span(context=context), None
+        _query_state.set((span, time.monotonic(), pending))
 
     def after_cursor_execute(
         self, conn, cursor, statement, parameters, context, executemany
     ):
-        if self.state.query_start_time:
-            query_duration = datetime.datetime.now() - self.state.query_start_time
-
-            beeline.add_context(
-                {
-                    "db.duration": query_duration.total_seconds() * 1000,
-                    "db.last_insert_id": getattr(cursor, "lastrowid", None),
-                    "db.rows_affected": cursor.rowcount,
-                }
-            )
-        if self.state.span:
-            beeline.finish_span(self.state.span)
+        span, query_start_time, pending = _query_state.get() or _NO_STATE
+
+        if query_start_time:
+            duration_ms = (time.monotonic() - query_start_time) * 1000
+
+            fields = {
+                "db.duration": duration_ms,
+                "db.rows_affected": cursor.rowcount,
+            }
+            if not _is_select(statement):
+                fields["db.last_insert_id"] = getattr(cursor, "lastrowid", None)
+
+            if pending is not None:
+                sample_rate = self.sample_weight(duration_ms)
+                if sample_rate:
+                    pending.update(fields)
+                    pending["db.sample_rate"] = sample_rate
+                    self.send_pending(pending, duration_ms)
+                else:
+                    beeline.add_rollup_field("db.unsampled_queries", 1)
+                    beeline.add_rollup_field("db.unsampled_duration", duration_ms)
+
+                    overlap_count = self.take_overlap_count()
+                    if overlap_count:
+                        beeline.add_rollup_field("db.overlap_count", overlap_count)
+            elif span:
+                # add straight to our span, skipping beeline's active span lookup
+                span.add_context(fields)
+        if span:
+            beeline.finish_span(span)
         self.reset_state()
 
+    def sample_weight(self, duration_ms):
+        # how many queries a sent span stands for, or 0 if it shouldn't be sent.
+        # Slow queries are always sent, so only stand for themselves
+        if self.min_duration_ms is not None and duration_ms >= self.min_duration_ms:
+            return 1
+        if self.sample_rate is not None and random.random() < self.sample_rate:
+            return 1 / self.sample_rate
+        return 0
+
+    def take_overlap_count(self):
+        if not self._overlap_count:
+            return 0
+        with self._overlap_lock:
+            overlap_count, self._overlap_count = self._overlap_count, 0
+        return overlap_count
+
+    def send_pending(self, pending, duration_ms):
+        overlap_count = self.take_overlap_count()
+        if overlap_count:
+            pending["db.overlap_count"] = overlap_count
+
+        span = beeline.start_span(context=pending)
+
+        if span and duration_ms is not None:
+            # move the span back to when the query started, so that its duration_ms
+            # and position in the trace match the query rather than the send.
+            # created_at is in UTC, so shift it by the same amount
+            wall_start = datetime.datetime.now() - datetime.timedelta(
+                milliseconds=duration_ms
+            )
+            span.event.created_at -= span.event.start_time - wall_start
+            span.event.start_time = wall_start
+        beeline.finish_span(span)
+
     def handle_error(self, context):
+        error = beeline.internal.stringify_exception(context.original_exception)
+
+        span, query_start_time, pending = _query_state.get() or _NO_STATE
 
-        beeline.add_context_field(
-            "db.error", beeline.internal.stringify_exception(context.original_exception)
-        )
-        if self.state.span:
-            beeline.finish_span(self.state.span)
+        if pending is not None:
+            # failed queries are always sent, regardless of duration or sampling
+            pending["db.error"] = error
+            pending["db.sample_rate"] = 1
+            duration_ms = None
+            if query_start_time:
+                duration_ms = (time.monotonic() - query_start_time) * 1000
+                pending["db.duration"] = duration_ms
+            self.send_pending(pending, duration_ms)
+        else:
+            beeline.add_context_field("db.error", error)
+        if span:
+            beeline.finish_span(span)
         self.reset_state()
 
 
@@ -11,9 +11,18 @@ setup(
     author_email="tech@pacerevenue.com",
     url="http://github.com/findpace/honeycomb-sqlalchemy",
     py_modules=["honeycomb_sqlalchemy"],
-    install_requires=["honeycomb-beeline", "sqlalchemy"],
+    install_requires=[
+        "honeycomb-beeline",
+        "sqlalchemy",
+        'contextvars; python_version < "3.7"',
+    ],
     extras_require={
-        "dev": ["coverage==5.5", "pytest==6.2.2", "psycopg2-binary==2.8.6"]
+        "dev": [
+            "coverage==5.5",
+            "pytest==6.2.2",
+            "psycopg2-binary==2.8.6",
+            "asyncpg==0.22.0",
+        ]
     },
     zip_safe=True,
     license="Apache License, Version 2.0",
@@ -1,18 +1,31 @@
 # -*- coding: utf-8 -*-
+import asyncio
 import os
+import sys
 import threading
 import time
-from datetime import datetime, timedelta
+import warnings
+from datetime import date, datetime, timedelta
 from unittest.mock import ANY, Mock, call, patch
 
 import pytest
-from honeycomb_sqlalchemy import SqlalchemyListeners
-from sqlalchemy import create_engine
+from honeycomb_sqlalchemy import SqlalchemyListeners, _query_state
+from sqlalchemy import create_engine, text
 from sqlalchemy.engine import Engine
 from sqlalchemy.exc import ProgrammingError
 from sqlalchemy.orm import scoped_session, sessionmaker
 
 
+@pytest.fixture(autouse=True)
+def query_state():
+    """ Query state is kept in a module level context variable, so make sure
+    one test's query in progress doesn't leak into the next.
+    """
+    _query_state.set(None)
+    yield
+    _query_state.set(None)
+
+
 @pytest.fixture
 def beeline():
     with patch("honeycomb_sqlalchemy.beeline") as patched:
@@ -28,14 +41,14 @@ def listeners():
 
 @pytest.fixture
 def now():
-    with patch("honeycomb_sqlalchemy.datetime") as patched:
+    with patch("honeycomb_sqlalchemy.time") as patched:
 
         def fix():
-            """ Return the current time and set it as the return value
+            """ Return the current monotonic time and set it as the return value
             of the mock.
             """
-            now = datetime.now()
-            patched.datetime.now.return_value = now
+            now = time.monotonic()
+            patched.monotonic.return_value = now
             return now
 
         yield fix
@@ -47,6 +60,11 @@ class TestInstall:
         with patch("honeycomb_sqlalchemy.event") as patched:
             yield patched.listen
 
+    @pytest.fixture(autouse=True)
+    def reset_installed(self):
+        yield
+        SqlalchemyListeners._installed = None
+
     def test_listeners(self, sqlalchemy_listen):
         listeners = SqlalchemyListeners()
         listeners.install()
@@ -68,30 +86,55 @@ class TestInstall:
         listeners.install()
         assert sqlalchemy_listen.call_count == 3
 
+    def test_install_once_per_process(self, sqlalchemy_listen, caplog):
+        listeners = SqlalchemyListeners()
+        listeners.install()
+
+        other = SqlalchemyListeners(min_duration_ms=100)
+        other.install()
+
+        assert listeners.installed
+        assert not other.installed
+        assert sqlalchemy_listen.call_count == 3
+        assert [record.levelname for record in caplog.records] == ["WARNING"]
+
+    def test_reinstall_same_instance_does_not_warn(self, sqlalchemy_listen, caplog):
+        listeners = SqlalchemyListeners()
+        listeners.install()
+        listeners.install()
+
+        assert not [r for r in caplog.records if r.levelname == "WARNING"]
+
+    def test_uninstall_other_instance(self, sqlalchemy_listen):
+        listeners = SqlalchemyListeners()
+        listeners.install()
+
+        with patch("honeycomb_sqlalchemy.event") as patched:
+            SqlalchemyListeners().uninstall()
+
+        assert not patched.remove.called
+        assert listeners.installed
+
 
 class TestResetState:
     def test_existing_state(self):
         listeners = SqlalchemyListeners()
-        listeners.state.span = Mock()
-        listeners.state.query_start_time = Mock()
+        _query_state.set((Mock(), Mock(), None))
 
         listeners.reset_state()
-        assert listeners.state.span is None
-        assert listeners.state.query_start_time is None
+        assert _query_state.get() is None
 
     def test_no_state(self):
         listeners = SqlalchemyListeners()
 
         listeners.reset_state()
-        assert listeners.state.span is None
-        assert listeners.state.query_start_time is None
+        assert _query_state.get() is None
 
 
 class TestBeforeCursorExecute:
     def test_warn_on_overlapping_events(self, beeline, listeners):
 
-        listeners.state.span = Mock()
-        listeners.state.query_start_time = Mock()
+        _query_state.set((Mock(), Mock(), None))
 
         args = [Mock() for _ in range(6)]
 
@@ -99,6 +142,42 @@ class TestBeforeCursorExecute:
             listeners.before_cursor_execute(*args)
 
         assert not beeline.start_span.called
+        assert listeners._overlap_count == 1
+
+    def test_overlapping_events_warn_once(self, beeline, listeners):
+
+        _query_state.set((Mock(), Mock(), None))
+
+        args = [Mock() for _ in range(6)]
+
+        with pytest.warns(UserWarning) as record:
+            listeners.before_cursor_execute(*args)
+            listeners.before_cursor_execute(*args)
+            listeners.before_cursor_execute(*args)
+
+        assert len(record) == 1
+        assert listeners._overlap_count == 3
+
+    def test_overlap_count_added_to_next_span(self, beeline, listeners):
+
+        listeners._overlap_count = 2
+
+        statement = Mock()
+        args = [Mock(), Mock(), statement, [], Mock(), Mock()]
+        listeners.before_cursor_execute(*args)
+
+        assert beeline.start_span.call_args_list == [
+            call(
+                context={
+                    "name": "sqlalchemy_query",
+                    "type": "db",
+                    "db.query": statement,
+                    "db.query_args": [],
+                    "db.overlap_count": 2,
+                }
+            )
+        ]
+        assert listeners._overlap_count == 0
 
     @pytest.mark.parametrize("type_", [list, tuple])
     def test_list_and_tuple_parameters(self, type_, beeline, listeners):
@@ -122,6 +201,68 @@ class TestBeforeCursorExecute:
             )
         ]
 
+    @pytest.mark.parametrize("parameters", [(), [], {}])
+    def test_no_parameters(self, parameters, beeline, listeners):
+
+        statement = Mock()
+
+        args = [Mock(), Mock(), statement, parameters, Mock(), Mock()]
+        listeners.before_cursor_execute(*args)
+
+        assert beeline.start_span.call_args_list == [
+            call(
+                context={
+                    "name": "sqlalchemy_query",
+                    "type": "db",
+                    "db.query": statement,
+                    "db.query_args": [],
+                }
+            )
+        ]
+
+    def test_unknown_parameters_not_truth_tested(self, beeline, listeners):
+
+        parameters = Mock(__bool__=Mock(side_effect=ValueError("ambiguous")))
+
+        args = [Mock(), Mock(), Mock(), parameters, Mock(), Mock()]
+        listeners.before_cursor_execute(*args)
+
+        (_, kwargs), = beeline.start_span.call_args_list
+        assert kwargs["context"]["db.query_args"] == []
+
+    def test_scalar_parameters_are_copied(self, beeline, listeners):
+
+        parameters = ["string", 123]
+
+        args = [Mock(), Mock(), Mock(), parameters, Mock(), Mock()]
+        listeners.before_cursor_execute(*args)
+
+        (_, kwargs), = beeline.start_span.call_args_list
+        assert kwargs["context"]["db.query_args"] == ["string", 123]
+        assert kwargs["context"]["db.query_args"] is not parameters
+
+    def test_date_and_time_parameters(self, beeline, listeners):
+
+        d = date.today()
+        t = datetime.now().time()
+
+        statement = Mock()
+        parameters = [d, t]
+
+        args = [Mock(), Mock(), statement, parameters, Mock(), Mock()]
+        listeners.before_cursor_execute(*args)
+
+        assert beeline.start_span.call_args_list == [
+            call(
+                context={
+                    "name": "sqlalchemy_query",
+                    "type": "db",
+                    "db.query": statement,
+                    "db.query_args": [d.isoformat(), t.isoformat()],
+                }
+            )
+        ]
+
     def test_dict_parameters(self, beeline, listeners):
 
         dt = datetime.now()
@@ -143,6 +284,19 @@ class TestBeforeCursorExecute:
             )
         ]
 
+    def test_dict_values_use_str(self, beeline, listeners):
+        class Money(float):
+            def __format__(self, spec):
+                return f"${float(self):.2f}"
+
+        parameters = {"m": Money(1.5)}
+
+        args = [Mock(), Mock(), Mock(), parameters, Mock(), Mock()]
+        listeners.before_cursor_execute(*args)
+
+        (_, kwargs), = beeline.start_span.call_args_list
+        assert kwargs["context"]["db.query_args"] == ["m=1.5"]
+
     def test_iterable_dict_values(self, beeline, listeners):
         """ Regression test for https://github.com/honeycombio/beeline-python/issues/159
         """
@@ -179,49 +333,72 @@ class TestBeforeCursorExecute:
 class TestAfterCursorExecute:
     def test_context(self, beeline, listeners, now):
 
-        start_time = now() - timedelta(seconds=1)
-        listeners.state.query_start_time = start_time
+        span = Mock()
+        _query_state.set((span, now() - 1, None))
 
-        args = [Mock() for _ in range(6)]
+        args = [Mock(), Mock(), "UPDATE foo", Mock(), Mock(), Mock()]
         cursor = args[1]
         listeners.after_cursor_execute(*args)
 
-        assert beeline.add_context.call_args_list == [
+        assert not beeline.add_context.called
+        assert span.add_context.call_args_list == [
             call(
                 {
-                    "db.duration": 1000,
+                    "db.duration": pytest.approx(1000),
                     "db.last_insert_id": cursor.lastrowid,
                     "db.rows_affected": cursor.rowcount,
                 }
             )
         ]
 
+    @pytest.mark.parametrize("statement", ["SELECT 1", "  select * from foo"])
+    def test_select_has_no_last_insert_id(self, statement, beeline, listeners, now):
+
+        span = Mock()
+        _query_state.set((span, now() - 1, None))
+
+        args = [Mock(), Mock(), statement, Mock(), Mock(), Mock()]
+        cursor = args[1]
+        listeners.after_cursor_execute(*args)
+
+        assert span.add_context.call_args_list == [
+            call(
+                {
+                    "db.duration": pytest.approx(1000),
+                    "db.rows_affected": cursor.rowcount,
+                }
+            )
+        ]
+
     def test_no_previous_start(self, beeline, listeners):
-        args = [Mock() for _ in range(6)]
+        span = Mock()
+        _query_state.set((span, None, None))
+
+        args = [Mock(), Mock(), "UPDATE foo", Mock(), Mock(), Mock()]
         listeners.after_cursor_execute(*args)
 
-        assert not beeline.add_context.called
+        assert not span.add_context.called
 
     def test_close_span(self, beeline, listeners):
 
         span = Mock()
-        listeners.state.span = span
+        _query_state.set((span, None, None))
 
-        args = [Mock() for _ in range(6)]
+        args = [Mock(), Mock(), "UPDATE foo", Mock(), Mock(), Mock()]
         listeners.after_cursor_execute(*args)
 
         assert beeline.finish_span.call_args_list == [call(span)]
 
     def test_no_open_span(self, beeline, listeners):
 
-        args = [Mock() for _ in range(6)]
+        args = [Mock(), Mock(), "UPDATE foo", Mock(), Mock(), Mock()]
         listeners.after_cursor_execute(*args)
 
         assert not beeline.finish_span.called
 
     def test_reset_state(self, beeline, listeners):
 
-        args = [Mock() for _ in range(6)]
+        args = [Mock(), Mock(), "UPDATE foo", Mock(), Mock(), Mock()]
         listeners.after_cursor_execute(*args)
 
         assert listeners.reset_state.called
@@ -245,13 +422,13 @@ class TestHandleError:
         listeners = SqlalchemyListeners()
 
         span = Mock()
-        listeners.state.span = span
+        _query_state.set((span, None, None))
 
         context = Mock()
         listeners.handle_error(context)
 
         assert beeline.finish_span.call_args_list == [call(span)]
-        assert listeners.state.span is None
+        assert _query_state.get() is None
 
     def test_no_open_span(self, beeline):
         listeners = SqlalchemyListeners()
@@ -268,16 +445,207 @@ class TestHandleError:
         assert listeners.reset_state.called
 
 
+class TestAsyncTasks:
+    @pytest.mark.skipif(
+        sys.version_info < (3, 7), reason="asyncio tasks copy contexts from python 3.7"
+    )
+    def test_state_is_per_task(self, beeline):
+        listeners = SqlalchemyListeners()
+        beeline.start_span.side_effect = lambda context: Mock(
+            query=context["db.query"]
+        )
+
+        async def query(statement, seconds):
+            listeners.before_cursor_execute(
+                Mock(), Mock(), statement, (), Mock(), Mock()
+            )
+            await asyncio.sleep(seconds)
+            listeners.after_cursor_execute(
+                Mock(), Mock(), statement, (), Mock(), Mock()
+            )
+
+        async def run():
+            await asyncio.gather(query("slow", 0.02), query("fast", 0.01))
+
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")
+            asyncio.run(run())
+
+        finished = [span.query for (span,), _ in beeline.finish_span.call_args_list]
+        assert finished == ["fast", "slow"]
+
+
+class TestDeferredSpans:
+    @pytest.fixture
+    def random(self):
+        with patch("honeycomb_sqlalchemy.random") as patched:
+            yield patched.random
+
+    @pytest.fixture
+    def wall_now(self):
+        now = datetime.now()
+        with patch("honeycomb_sqlalchemy.datetime") as patched:
+            patched.datetime.now.return_value = now
+            patched.timedelta = timedelta
+            yield now
+
+    def test_span_not_started(self, beeline):
+        listeners = SqlalchemyListeners(min_duration_ms=100)
+
+        statement = Mock()
+        args = [Mock(), Mock(), statement, [], Mock(), Mock()]
+        listeners.before_cursor_execute(*args)
+
+        assert not beeline.start_span.called
+        assert _query_state.get()[2] == {
+            "name": "sqlalchemy_query",
+            "type": "db",
+            "db.query": statement,
+            "db.query_args": [],
+        }
+
+    def test_slow_query(self, beeline, now):
+        listeners = SqlalchemyListeners(min_duration_ms=100)
+        _query_state.set((None, now() - 1, {"name": "sqlalchemy_query"}))
+
+        args = [Mock(), Mock(), "UPDATE foo", Mock(), Mock(), Mock()]
+        cursor = args[1]
+        listeners.after_cursor_execute(*args)
+
+        assert beeline.start_span.call_args_list == [
+            call(
+                context={
+                    "name": "sqlalchemy_query",
+                    "db.duration": pytest.approx(1000),
+                    "db.last_insert_id": cursor.lastrowid,
+                    "db.rows_affected": cursor.rowcount,
+                    "db.sample_rate": 1,
+                }
+            )
+        ]
+        assert beeline.finish_span.call_args_list == [
+            call(beeline.start_span.return_value)
+        ]
+        assert not beeline.add_context.called
+        assert _query_state.get() is None
+
+    def test_span_backdated_to_query_start(self, beeline, now, wall_now):
+        listeners = SqlalchemyListeners(min_duration_ms=100)
+        _query_state.set((None, now() - 1, {"name": "sqlalchemy_query"}))
+
+        span = beeline.start_span.return_value
+        span.event.start_time = wall_now
+        span.event.created_at = wall_now - timedelta(hours=1)  # e.g. UTC offset
+
+        args = [Mock(), Mock(), "UPDATE foo", Mock(), Mock(), Mock()]
+        listeners.after_cursor_execute(*args)
+
+        assert beeline.finish_span.call_args_list == [call(span)]
+        query_start = wall_now - timedelta(seconds=1)
+        assert span.event.start_time == query_start
+        assert span.event.created_at == query_start - timedelta(hours=1)
+
+    def test_fast_query(self, beeline, now, random):
+        random.return_value = 0.5
+        listeners = SqlalchemyListeners(min_duration_ms=100, sample_rate=0.1)
+        _query_state.set((None, now() - 0.01, {"name": "sqlalchemy_query"}))
+
+        args = [Mock(), Mock(), "UPDATE foo", Mock(), Mock(), Mock()]
+        listeners.after_cursor_execute(*args)
+
+        assert not beeline.start_span.called
+        assert not beeline.finish_span.called
+        assert beeline.add_rollup_field.call_args_list == [
+            call("db.unsampled_queries", 1),
+            call("db.unsampled_duration", pytest.approx(10)),
+        ]
+
+    def test_sampled_query(self, beeline, now, random):
+        random.return_value = 0.05
+        listeners = SqlalchemyListeners(sample_rate=0.1)
+        _query_state.set((None, now(), {"name": "sqlalchemy_query"}))
+
+        args = [Mock(), Mock(), "UPDATE foo", Mock(), Mock(), Mock()]
+        listeners.after_cursor_execute(*args)
+
+        (_, kwargs), = beeline.start_span.call_args_list
+        assert kwargs["context"]["db.sample_rate"] == pytest.approx(10)
+        assert beeline.finish_span.call_args_list == [
+            call(beeline.start_span.return_value)
+        ]
+        assert not beeline.add_rollup_field.called
+
+    def test_overlap_count_kept_until_sent(self, beeline, now, random):
+        now()
+        random.return_value = 0.5
+        listeners = SqlalchemyListeners(sample_rate=0.1)
+        listeners._overlap_count = 2
+
+        args = [Mock(), Mock(), "UPDATE foo", [], Mock(), Mock()]
+        listeners.before_cursor_execute(*args)
+
+        assert listeners._overlap_count == 2
+        assert "db.overlap_count" not in _query_state.get()[2]
+
+        random.return_value = 0.05
+        listeners.after_cursor_execute(*args)
+
+        (_, kwargs), = beeline.start_span.call_args_list
+        assert kwargs["context"]["db.overlap_count"] == 2
+        assert listeners._overlap_count == 0
+
+    def test_overlap_count_rolled_up_when_unsampled(self, beeline, now, random):
+        random.return_value = 0.5
+        listeners = SqlalchemyListeners(sample_rate=0.1)
+        listeners._overlap_count = 2
+        _query_state.set((None, now(), {"name": "sqlalchemy_query"}))
+
+        args = [Mock(), Mock(), "UPDATE foo", Mock(), Mock(), Mock()]
+        listeners.after_cursor_execute(*args)
+
+        assert not beeline.start_span.called
+        assert call("db.overlap_count", 2) in beeline.add_rollup_field.call_args_list
+        assert listeners._overlap_count == 0
+
+    def test_error_always_sent(self, beeline, now, wall_now):
+        listeners = SqlalchemyListeners(min_duration_ms=100)
+        _query_state.set((None, now() - 1, {"name": "sqlalchemy_query"}))
+
+        span = beeline.start_span.return_value
+        span.event.start_time = span.event.created_at = wall_now
+
+        context = Mock()
+        listeners.handle_error(context)
+
+        assert beeline.start_span.call_args_list == [
+            call(
+                context={
+                    "name": "sqlalchemy_query",
+                    "db.error": beeline.internal.stringify_exception.return_value,
+                    "db.sample_rate": 1,
+                    "db.duration": pytest.approx(1000),
+                }
+            )
+        ]
+        assert beeline.finish_span.call_args_list == [call(span)]
+        assert span.event.start_time == wall_now - timedelta(seconds=1)
+        assert not beeline.add_context_field.called
+        assert _query_state.get() is None
+
+
 class TestIntegration:
     @pytest.fixture
-    def db(self):
-        engine = create_engine(
-            f"postgresql://"
+    def dsn(self):
+        return (
             f"{os.environ.get('PG_USER', 'postgres')}:"
             f"{os.environ.get('PG_PASS', 'password')}@"
             f"{os.environ.get('PG_HOST', 'localhost')}/"
             f"{os.environ.get('PG_DB', 'postgres')}"
         )
+
+    @pytest.fixture
+    def db(self, dsn):
+        engine = create_engine(f"postgresql://{dsn}")
         return scoped_session(sessionmaker(bind=engine))
 
     @pytest.fixture
@@ -304,10 +672,8 @@ class TestIntegration:
         assert beeline.finish_span.call_args_list == [
             call(beeline.start_span.return_value)
         ]
-        assert beeline.add_context.call_args_list == [
-            call(
-                {"db.duration": ANY, "db.last_insert_id": ANY, "db.rows_affected": ANY}
-            )
+        assert beeline.start_span.return_value.add_context.call_args_list == [
+            call({"db.duration": ANY, "db.rows_affected": ANY})
         ]
 
     def test_error(self, listeners, beeline, db):
@@ -344,8 +710,40 @@ class TestIntegration:
         t1.join()
         t2.join()
 
-        assert beeline.add_context.call_count == 2
-        (call1_args, _), (call2_args, _) = beeline.add_context.call_args_list
+        span = beeline.start_span.return_value
+        assert span.add_context.call_count == 2
+        (call1_args, _), (call2_args, _) = span.add_context.call_args_list
 
         assert int(call1_args[0]["db.duration"] / 10) == 10  # ~0.1 seconds
         assert int(call2_args[0]["db.duration"] / 10) == 5  # ~0.05 seconds
+
+    @pytest.mark.skipif(
+        sys.version_info < (3, 7), reason="asyncio tasks copy contexts from python 3.7"
+    )
+    def test_async_concurrency(self, listeners, beeline, dsn):
+        pytest.importorskip("asyncpg")
+        sqlalchemy_asyncio = pytest.importorskip("sqlalchemy.ext.asyncio")
+
+        engine = sqlalchemy_asyncio.create_async_engine(f"postgresql+asyncpg://{dsn}")
+
+        async def query(seconds):
+            async with sqlalchemy_asyncio.AsyncSession(engine) as session:
+                await session.execute(text(f"SELECT pg_sleep({seconds})"))
+
+        async def run():
+            # both queries share the event loop thread, and overlap
+            await asyncio.gather(query(0.1), query(0.05))
+            await engine.dispose()
+
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")
+            asyncio.run(run())
+
+        span = beeline.start_span.return_value
+        assert span.add_context.call_count == 2
+        durations = sorted(
+            args[0]["db.duration"] for args, _ in span.add_context.call_args_list
+        )
+
+        assert int(durations[0] / 10) == 5  # ~0.05 seconds
+        assert int(durations[1] / 10) == 10  # ~0.1 seconds